@@ -1,13 +1,21 @@
 from __future__ import annotations
 
-from typing import TypedDict, Literal, List, Dict, Any, Optional
+import asyncio
+import difflib
+import functools
+import re
+import sys
+import threading
+from collections import OrderedDict, deque
+from typing import TypedDict, Literal, List, Dict, Any, Optional, Tuple
+import orjson
 from pydantic import BaseModel, Field
 
 from langgraph.graph import StateGraph, END
 from langchain_core.messages import SystemMessage, HumanMessage, AIMessage
 from langchain_ollama import ChatOllama
 
-from prompts import SYSTEM_PROMPT, ROUTER_PROMPT
+from prompts import SYSTEM_PROMPT, ROUTER_SYSTEM_PROMPT, ANSWER_PROMPT_TEMPLATE
 import tools
 
 
@@ -16,6 +24,9 @@ import tools
 # -----------------------------
 class AgentState(TypedDict):
     messages: List[Any]
+    user_text: str
+    tool_bits: int
+    stream: bool
     route: Optional[str]
     retrieved: Optional[List[Dict[str, str]]]
     tool_error: Optional[str]
@@ -25,8 +36,9 @@ class AgentState(TypedDict):
 # -----------------------------
 # Structured outputs
 # -----------------------------
-class RouteDecision(BaseModel):
-    action: Literal["RETRIEVE", "TIME", "CHECK", "ANSWER"] = Field(..., description="Next action the agent should take.")
+class RouterAndMaybeAnswer(BaseModel):
+    action: Literal["RETRIEVE", "TIME", "CHECK", "MULTI", "ANSWER"] = Field(..., description="Next action the agent should take.")
+    answer: Optional[str] = Field(default=None, description="Direct answer when action is ANSWER; otherwise empty.")
 
 
 class FinalAnswer(BaseModel):
@@ -38,53 +50,207 @@ class FinalAnswer(BaseModel):
 # -----------------------------
 # LLM
 # -----------------------------
-llm = ChatOllama(model="llama3", temperature=0.2)
+# keep_alive keeps the model (and its prompt-prefix KV cache) resident between
+# turns, so the constant system preamble is only prefilled once.
+MODEL = "llama3"
+llm = ChatOllama(model=MODEL, temperature=0.2, keep_alive="24h", num_ctx=4096)
+# built once: with_structured_output() rebuilds the schema/parser on every call
+_router_llm = llm.with_structured_output(RouterAndMaybeAnswer)
+
+
+# same model/options as llm (so no reload), but stops after one token
+_warmup_llm = llm.model_copy(update={"num_predict": 1})
+
+
+def _warmup() -> None:
+    # Load the model and prime the router's system block, since the router makes the first real call.
+    try:
+        _warmup_llm.invoke([SystemMessage(content=ROUTER_SYSTEM_PROMPT), HumanMessage(content="ping")])
+    except Exception:
+        pass  # Ollama not up yet; the first real call will surface the error
+
+
+# -----------------------------
+# Router cache
+# -----------------------------
+# Queries that obviously ask for the clock skip the LLM entirely.
+_TIME_RE = re.compile(r"\b(what(?:'s| is) the (?:time|date)|current (?:time|date)|time now|today's date)\b")
+_WS_RE = re.compile(r"\s+")
+# Recently routed (normalized) queries, used for near-duplicate lookups. The set
+# mirrors the deque for O(1) membership; both are shared by batch threads.
+_recent_queries: deque = deque(maxlen=1024)
+_recent_set: set = set()
+_recent_lock = threading.Lock()
+# normalized query -> action, least recently used first. Answers are never
+# cached: a repeat ANSWER decision goes to answer_node for a fresh reply.
+_route_cache: "OrderedDict[str, str]" = OrderedDict()
+_route_lock = threading.Lock()
+_ROUTE_CACHE_SIZE = 1024
+
+
+def _remember_query(text: str) -> None:
+    with _recent_lock:
+        if text in _recent_set:
+            return
+        if len(_recent_queries) == _recent_queries.maxlen:
+            _recent_set.discard(_recent_queries.popleft())
+        _recent_queries.append(text)
+        _recent_set.add(text)
+
+
+def _normalize(text: str) -> str:
+    return _WS_RE.sub(" ", text.lower()).strip()
+
+
+def _invoke_router(user_text: str) -> Tuple[str, Optional[str]]:
+    # constant instructions first, mutable user text last (prefix-cache friendly)
+    prompt = [
+        SystemMessage(content=ROUTER_SYSTEM_PROMPT),
+        HumanMessage(content=f"User query:\n{user_text}")
+    ]
+    decision = _router_llm.invoke(prompt)
+    return decision.action, decision.answer
+
+
+def _route_for(key: str, user_text: str) -> Tuple[str, Optional[str]]:
+    # cached on the normalized key, but the model sees the original text:
+    # an ANSWER reply must keep the user's casing and layout
+    with _route_lock:
+        hit = _route_cache.get(key)
+        if hit is not None:
+            _route_cache.move_to_end(key)
+            return hit, None
+    action, answer = _invoke_router(user_text)
+    with _route_lock:
+        _route_cache[key] = action
+        if len(_route_cache) > _ROUTE_CACHE_SIZE:
+            _route_cache.popitem(last=False)
+    return action, answer
+
+
+def _cached_route(user_text: str) -> Tuple[str, Optional[str]]:
+    """Return (action, answer); answer is only set when the router LLM was just called for this query."""
+    text = _normalize(user_text)
+    if _TIME_RE.search(text):
+        return "TIME", None
+    with _recent_lock:
+        seen = text in _recent_set
+        snapshot = None if seen else list(_recent_queries)
+    if not seen:
+        # scan a snapshot: other threads may append while difflib iterates
+        close = difflib.get_close_matches(text, snapshot, n=1, cutoff=0.95)
+        if close:
+            with _route_lock:
+                hit = _route_cache.get(close[0])
+            if hit is not None:
+                # near-duplicate of a routed query -> reuse its decision
+                return hit, None
+        _remember_query(text)
+    return _route_for(text, user_text)
+
+
+# Rough token budget (whitespace-split words) for retrieved context in the answer prompt.
+MAX_CTX_TOKENS = 512
+
+
+@functools.lru_cache(maxsize=256)
+def _format_context(user_text: str, snippets: Tuple[Tuple[str, str], ...]) -> str:
+    # Identical retrievals yield a byte-identical block, which keeps Ollama's prefix cache warm.
+    ranked = tools.rank_snippets(user_text, [{"title": t, "text": x} for t, x in snippets])
+    lines = []
+    budget = MAX_CTX_TOKENS
+    for _, r in ranked:
+        line = f"- {r['title']}: {r['text']}"
+        cost = len(line.split())
+        if cost > budget:
+            continue
+        lines.append(line)
+        budget -= cost
+    return "Retrieved context:\n" + "\n".join(lines) if lines else ""
+
+
+# Bit flags recorded in state["tool_bits"] by each tool node.
+TOOL_SEARCH = 1
+TOOL_TIME = 2
+TOOL_CHECK = 4
+# alphabetical, so FinalAnswer.used_tools comes out sorted
+_TOOL_NAMES = (
+    (TOOL_CHECK, "flaky_dependency_check"),
+    (TOOL_TIME, "get_time"),
+    (TOOL_SEARCH, "search_policy_snippets"),
+)
 
 
 def _last_user_text(state: AgentState) -> str:
-    for m in reversed(state["messages"]):
-        if isinstance(m, HumanMessage):
-            return m.content
-    return ""
+    # set once per turn by the caller; avoids rescanning the message history
+    return state["user_text"]
+
+
+def _finalize(state: AgentState, answer: str) -> None:
+    final = FinalAnswer(
+        answer=answer,
+        used_tools=[name for bit, name in _TOOL_NAMES if state["tool_bits"] & bit],
+        notes=("A tool failed; I used fallback reasoning." if state.get("tool_error") else "Answered with available context/tools.")
+    )
+    payload = orjson.dumps(final.model_dump(), option=orjson.OPT_INDENT_2).decode()
+    state["messages"].append(AIMessage(content=f"[final]\n{payload}"))
 
 
 # -----------------------------
 # Nodes
 # -----------------------------
 def router_node(state: AgentState) -> AgentState:
-    user_text = _last_user_text(state)
-    prompt = [
-        SystemMessage(content=SYSTEM_PROMPT),
-        HumanMessage(content=f"{ROUTER_PROMPT}\n\nUser query:\n{user_text}")
-    ]
-    decision = llm.with_structured_output(RouteDecision).invoke(prompt)
-    state["route"] = decision.action
-    state["messages"].append(AIMessage(content=f"[router] action={decision.action}"))
+    action, answer = _cached_route(_last_user_text(state))
+    state["messages"].append(AIMessage(content=f"[router] action={action}"))
+    if action == "ANSWER" and answer:
+        # the router already answered: skip the second LLM round-trip
+        if state.get("stream", True):
+            print(f"\nAssistant: {answer}")
+        _finalize(state, answer)
+        state["route"] = "DONE"
+    else:
+        state["route"] = action
     return state
 
 
-def retrieve_node(state: AgentState) -> AgentState:
+async def retrieve_node(state: AgentState) -> AgentState:
     q = _last_user_text(state)
-    state["retrieved"] = tools.search_policy_snippets(q)
+    state["retrieved"] = await asyncio.to_thread(tools.search_policy_snippets, q)
+    state["tool_bits"] |= TOOL_SEARCH
     state["messages"].append(AIMessage(content=f"[tool] retrieved {len(state['retrieved'])} snippets"))
     return state
 
 
-def time_node(state: AgentState) -> AgentState:
-    now = tools.get_time()
+async def time_node(state: AgentState) -> AgentState:
+    now = await asyncio.to_thread(tools.get_time)
+    state["tool_bits"] |= TOOL_TIME
     state["messages"].append(AIMessage(content=f"[tool] current_time={now}"))
     return state
 
 
-def check_node(state: AgentState) -> AgentState:
+async def check_node(state: AgentState) -> AgentState:
     # Demonstrate a tool that can fail + fallback
-    try:
-        msg = tools.flaky_dependency_check()
-        state["tool_error"] = None
-        state["messages"].append(AIMessage(content=f"[tool] check={msg}"))
-    except Exception as e:
-        state["tool_error"] = str(e)
-        state["messages"].append(AIMessage(content=f"[tool] check_error={state['tool_error']}"))
+    state["tool_bits"] |= TOOL_CHECK
+    ok, msg = await asyncio.to_thread(tools.flaky_dependency_check_v2)
+    state["tool_error"] = None if ok else msg
+    state["messages"].append(AIMessage(content=f"[tool] check={msg}" if ok else f"[tool] check_error={msg}"))
+    return state
+
+
+async def tools_fanout_node(state: AgentState) -> AgentState:
+    # Run all tools concurrently: wall-clock is max(tools) instead of sum(tools)
+    q = _last_user_text(state)
+    retrieved, now, (ok, msg) = await asyncio.gather(
+        asyncio.to_thread(tools.search_policy_snippets, q),
+        asyncio.to_thread(tools.get_time),
+        asyncio.to_thread(tools.flaky_dependency_check_v2),
+    )
+    state["retrieved"] = retrieved
+    state["tool_error"] = None if ok else msg
+    state["tool_bits"] |= TOOL_SEARCH | TOOL_TIME | TOOL_CHECK
+    state["messages"].append(AIMessage(content=f"[tool] retrieved {len(retrieved)} snippets"))
+    state["messages"].append(AIMessage(content=f"[tool] current_time={now}"))
+    state["messages"].append(AIMessage(content=f"[tool] check={msg}" if ok else f"[tool] check_error={msg}"))
     return state
 
 
@@ -93,42 +259,30 @@ def answer_node(state: AgentState) -> AgentState:
     retrieved = state.get("retrieved") or []
     tool_error = state.get("tool_error")
 
-    context = ""
-    if retrieved:
-        context_lines = [f"- {r['title']}: {r['text']}" for r in retrieved]
-        context = "Retrieved context:\n" + "\n".join(context_lines)
+    context = _format_context(user_text, tuple((r["title"], r["text"]) for r in retrieved))
 
     if tool_error:
         context += f"\n\nTool error observed: {tool_error}"
 
     prompt = [
         SystemMessage(content=SYSTEM_PROMPT),
-        HumanMessage(content=f"""User request:
-{user_text}
-
-{context}
-
-Write the best possible answer. If uncertainty exists, say it and propose a safe next step.""")
+        HumanMessage(content=ANSWER_PROMPT_TEMPLATE.format(user_text=user_text, context=context))
     ]
 
-    resp = llm.invoke(prompt)
-    # minimal "used tools" inference from messages
-    used_tools = []
-    for m in state["messages"]:
-        if isinstance(m, AIMessage) and m.content.startswith("[tool]"):
-            if "retrieved" in m.content:
-                used_tools.append("search_policy_snippets")
-            if "current_time" in m.content:
-                used_tools.append("get_time")
-            if "check=" in m.content or "check_error" in m.content:
-                used_tools.append("flaky_dependency_check")
-
-    final = FinalAnswer(
-        answer=resp.content,
-        used_tools=sorted(list(set(used_tools))),
-        notes=("A tool failed; I used fallback reasoning." if tool_error else "Answered with available context/tools.")
-    )
-    state["messages"].append(AIMessage(content=f"[final]\n{final.model_dump_json(indent=2)}"))
+    content_parts = []
+    if state.get("stream", True):
+        # stream tokens to the terminal as they arrive instead of blocking on the full reply
+        sys.stdout.write("\nAssistant: ")
+        for chunk in llm.stream(prompt):
+            content_parts.append(chunk.content)
+            sys.stdout.write(chunk.content)
+            sys.stdout.flush()
+        sys.stdout.write("\n")
+    else:
+        # batch mode: concurrent turns would interleave on stdout
+        content_parts.append(llm.invoke(prompt).content)
+
+    _finalize(state, "".join(content_parts))
     return state
 
 
@@ -162,6 +316,7 @@ graph.add_node("router", router_node)
 graph.add_node("retrieve", retrieve_node)
 graph.add_node("time", time_node)
 graph.add_node("check", check_node)
+graph.add_node("tools_fanout", tools_fanout_node)
 graph.add_node("fallback", fallback_node)
 graph.add_node("answer", answer_node)
 
@@ -174,13 +329,16 @@ graph.add_conditional_edges(
         "RETRIEVE": "retrieve",
         "TIME": "time",
         "CHECK": "check",
+        "MULTI": "tools_fanout",
         "ANSWER": "answer",
+        "DONE": END,
     },
 )
 
-# after retrieve/time -> answer
+# after retrieve/time/fanout -> answer (fanout already retrieved, so no fallback)
 graph.add_edge("retrieve", "answer")
 graph.add_edge("time", "answer")
+graph.add_edge("tools_fanout", "answer")
 
 # after check -> either fallback or answer
 graph.add_conditional_edges(
@@ -203,33 +361,70 @@ app = graph.compile()
 # -----------------------------
 # CLI runner
 # -----------------------------
+# Shallow-copied per turn; every mutable field is replaced in _new_state.
+_STATE_TEMPLATE: AgentState = {
+    "messages": [],
+    "user_text": "",
+    "tool_bits": 0,
+    "stream": True,
+    "route": None,
+    "retrieved": None,
+    "tool_error": None,
+    "attempts": 0,
+}
+
+
+def _new_state(user: str, stream: bool = True) -> AgentState:
+    state = _STATE_TEMPLATE.copy()
+    state["messages"] = [HumanMessage(content=user)]
+    state["user_text"] = user
+    state["stream"] = stream
+    return state
+
+
+def _final_block(out: AgentState) -> Optional[str]:
+    final_blocks = [m.content for m in out["messages"] if isinstance(m, AIMessage) and m.content.startswith("[final]")]
+    return final_blocks[-1].replace("[final]\n", "") if final_blocks else None
+
+
 def run_cli():
     print("LangGraph demo (Ollama llama3). Type 'exit' to quit.\n")
+    threading.Thread(target=_warmup, daemon=True).start()
     while True:
         user = input("You: ").strip()
         if user.lower() in {"exit", "quit"}:
             break
 
-        state: AgentState = {
-            "messages": [HumanMessage(content=user)],
-            "route": None,
-            "retrieved": None,
-            "tool_error": None,
-            "attempts": 0,
-        }
+        state = _new_state(user)
 
         # run once
-        out = app.invoke(state)
+        out = asyncio.run(app.ainvoke(state))
 
         # Print the final JSON block nicely
-        final_blocks = [m.content for m in out["messages"] if isinstance(m, AIMessage) and m.content.startswith("[final]")]
-        if final_blocks:
-            print("\nAssistant:")
-            print(final_blocks[-1].replace("[final]\n", ""))
+        final = _final_block(out)
+        if final:
+            print("\nFinal:")
+            print(final)
             print("")
         else:
             print("\nAssistant: (no final output)\n")
 
 
+def run_batch(queries: List[str], max_concurrency: int = 8) -> List[Optional[str]]:
+    """Run independent queries concurrently; returns the final JSON block for each.
+
+    Every request shares the same system prompt, so Ollama can batch them and
+    reuse the cached prefix KV instead of prefilling it once per query.
+    """
+    states = [_new_state(q, stream=False) for q in queries]
+    outs = asyncio.run(app.abatch(states, config={"max_concurrency": max_concurrency}))
+    return [_final_block(out) for out in outs]
+
+
 if __name__ == "__main__":
-    run_cli()
\ No newline at end of file
+    if len(sys.argv) > 1:
+        # non-interactive: python agent.py "query one" "query two" ...
+        for query, final in zip(sys.argv[1:], run_batch(sys.argv[1:])):
+            print(f"You: {query}\n{final or '(no final output)'}\n")
+    else:
+        run_cli()
@@ -1,12 +1,28 @@
 from typing import TypedDict, Literal, Optional
+import ast
+import functools
+import operator
+from pydantic import BaseModel, Field
 from langchain_ollama import ChatOllama
 from langgraph.graph import StateGraph, END
-import json
+import re
+import sys
+import threading
 
 # ---------------------------
 # LLM
 # ---------------------------
-LLM = ChatOllama(model="llama3", temperature=0.2)
+LLM = ChatOllama(model="llama3", temperature=0.2, keep_alive="24h", num_ctx=4096)
+
+# same model/options as LLM (so no reload), but stops after one token
+_WARMUP_LLM = LLM.model_copy(update={"num_predict": 1})
+
+def _warmup() -> None:
+    # Load the model before the first real query (runs in a background thread).
+    try:
+        _WARMUP_LLM.invoke("ping")
+    except Exception:
+        pass  # Ollama not up yet; the first real call will surface the error
 
 # ---------------------------
 # State
@@ -20,25 +36,96 @@ class AgentState(TypedDict):
     answer: str
     error: Optional[str]
 
+# ---------------------------
+# Structured outputs
+# ---------------------------
+class ToolPlan(BaseModel):
+    tool_name: Literal["calculator", "none"] = Field(..., description="Tool to run, or none.")
+    tool_input: str = Field(default="", description="Arithmetic expression for the calculator.")
+
+PLANNER = LLM.with_structured_output(ToolPlan)
+
 # ---------------------------
 # Tool (safe-ish calculator)
 # ---------------------------
+# `**` passes the character whitelist, so cap it: 9**9**9 would otherwise hang the CLI.
+_MAX_EXPONENT = 100
+_MAX_POW_BITS = 10_000
+
+def _safe_pow(base, exp):
+    if abs(exp) > _MAX_EXPONENT:
+        raise ValueError(f"Exponent too large (max {_MAX_EXPONENT}).")
+    if isinstance(base, int) and isinstance(exp, int) and exp > 0 and base.bit_length() * exp > _MAX_POW_BITS:
+        raise ValueError("Result too large.")
+    return operator.pow(base, exp)
+
+_BIN_OPS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv,
+    ast.Mod: operator.mod,
+    ast.Pow: _safe_pow,
+}
+_UNARY_OPS = {
+    ast.UAdd: operator.pos,
+    ast.USub: operator.neg,
+}
+
+@functools.lru_cache(maxsize=1024)
+def _parse(expr: str) -> ast.expr:
+    return ast.parse(expr.strip(), mode="eval").body
+
+def _eval_node(node: ast.expr):
+    if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)):
+        return node.value
+    if isinstance(node, ast.BinOp) and type(node.op) in _BIN_OPS:
+        return _BIN_OPS[type(node.op)](_eval_node(node.left), _eval_node(node.right))
+    if isinstance(node, ast.UnaryOp) and type(node.op) in _UNARY_OPS:
+        return _UNARY_OPS[type(node.op)](_eval_node(node.operand))
+    raise ValueError("Unsupported expression.")
+
 def calculator(expr: str) -> str:
     allowed = set("0123456789+-*/(). %")
     if any(ch not in allowed for ch in expr):
         raise ValueError("Unsupported characters in expression.")
-    return str(eval(expr, {"__builtins__": {}}, {}))
+    # walk the parsed AST instead of eval(): no compile step, no interpreter escape hatch
+    return str(_eval_node(_parse(expr)))
 
 # ---------------------------
 # Nodes
 # ---------------------------
+# Input that is nothing but an arithmetic expression (digits, operators, parens).
+_ARITH_RE = re.compile(r"^[\s0-9+\-*/().%]+$")
+
+def _is_arithmetic(text: str) -> bool:
+    text = text.strip()
+    return bool(_ARITH_RE.match(text)) and any(ch.isdigit() for ch in text)
+
+def _stream_answer(prompt: str) -> str:
+    # print tokens as they arrive; the user sees the first token instead of waiting for all of them
+    sys.stdout.write("Assistant: ")
+    content_parts = []
+    for chunk in LLM.stream(prompt):
+        content_parts.append(chunk.content)
+        sys.stdout.write(chunk.content)
+        sys.stdout.flush()
+    sys.stdout.write("\n")
+    return "".join(content_parts).strip()
+
 def route_node(state: AgentState) -> AgentState:
+    if _is_arithmetic(state["user_input"]):
+        # obvious calculator input: no need to ask the LLM
+        state["route"] = "tool"
+        return state
+    # constant instructions form a fixed prefix; user text goes last
     prompt = (
         "You are a router.\n"
         "If the user asks to calculate something, convert units, or do arithmetic -> TOOL.\n"
         "Otherwise -> DIRECT.\n"
-        f"User: {state['user_input']}\n"
-        "Return only: TOOL or DIRECT."
+        "Return only: TOOL or DIRECT.\n"
+        f"User: {state['user_input']}"
     )
     decision = LLM.invoke(prompt).content.strip().upper()
     decision = decision.split()[0]  # avoids 'NO TOOL' bug
@@ -46,27 +133,32 @@ def route_node(state: AgentState) -> AgentState:
     return state
 
 def plan_tool_node(state: AgentState) -> AgentState:
+    user_input = state["user_input"].strip()
+    if _is_arithmetic(user_input):
+        # the input already is the expression: no LLM plan needed
+        state["tool_name"] = "calculator"
+        state["tool_input"] = user_input
+        state["error"] = None
+        return state
+
     prompt = (
         "You are a planner.\n"
         "If the user asks for arithmetic, choose calculator and extract the expression.\n"
         "Otherwise choose none.\n"
-        "Return ONLY valid JSON. No extra text.\n"
-        'Schema: {"tool_name":"calculator"|"none","tool_input":"..."}\n'
-        'Example: User:"12*7 + 5" -> {"tool_name":"calculator","tool_input":"12*7 + 5"}\n'
-        'Example: User:"Explain tool calling" -> {"tool_name":"none","tool_input":""}\n'
+        'Example: User:"12*7 + 5" -> tool_name=calculator, tool_input="12*7 + 5"\n'
+        'Example: User:"Explain tool calling" -> tool_name=none, tool_input=""\n'
         f'User:"{state["user_input"]}"'
     )
-    raw = LLM.invoke(prompt).content.strip()
 
     try:
-        plan_json = json.loads(raw)
-        state["tool_name"] = plan_json.get("tool_name", "none")
-        state["tool_input"] = plan_json.get("tool_input", "")
+        plan = PLANNER.invoke(prompt)
+        state["tool_name"] = plan.tool_name
+        state["tool_input"] = plan.tool_input
         state["error"] = None
-    except Exception:
+    except Exception as e:
         state["tool_name"] = "none"
         state["tool_input"] = ""
-        state["error"] = f"Failed to parse JSON plan: {raw}"
+        state["error"] = f"Failed to get tool plan: {e}"
 
     return state
 
@@ -88,20 +180,21 @@ def fallback_node(state: AgentState) -> AgentState:
         "I can help — quick question so I don’t guess: "
         "what exact calculation or input should I use?"
     )
+    print("Assistant:", state["answer"])
     return state
 
 def direct_answer_node(state: AgentState) -> AgentState:
     prompt = f"Answer clearly and practically.\nUser: {state['user_input']}"
-    state["answer"] = LLM.invoke(prompt).content.strip()
+    state["answer"] = _stream_answer(prompt)
     return state
 
 def final_answer_node(state: AgentState) -> AgentState:
     prompt = (
         "Use the tool result to answer the user concisely.\n"
-        f"User: {state['user_input']}\n"
         f"Tool result: {state.get('tool_result')}\n"
+        f"User: {state['user_input']}"
     )
-    state["answer"] = LLM.invoke(prompt).content.strip()
+    state["answer"] = _stream_answer(prompt)
     return state
 
 # ---------------------------
@@ -157,22 +250,27 @@ APP = graph.compile()
 # ---------------------------
 # CLI
 # ---------------------------
+# Fresh per-turn state is a shallow copy of this (all values are immutable).
+_STATE_TEMPLATE: AgentState = {
+    "user_input": "",
+    "route": "direct",
+    "tool_name": None,
+    "tool_input": None,
+    "tool_result": None,
+    "answer": "",
+    "error": None,
+}
+
 def main():
     print("LangGraph Flow Agent (no RAG). Type 'exit' to quit.\n")
+    threading.Thread(target=_warmup, daemon=True).start()
     while True:
         user = input("You: ").strip()
         if user.lower() in {"exit", "quit"}:
             break
 
-        state: AgentState = {
-            "user_input": user,
-            "route": "direct",
-            "tool_name": None,
-            "tool_input": None,
-            "tool_result": None,
-            "answer": "",
-            "error": None,
-        }
+        state = _STATE_TEMPLATE.copy()
+        state["user_input"] = user
 
         out = APP.invoke(state)
 
@@ -184,7 +282,5 @@ def main():
         print("error:", out.get("error"))
         print("-------------\n")
 
-        print("Assistant:", out["answer"], "\n")
-
 if __name__ == "__main__":
     main()
\ No newline at end of file
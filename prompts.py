@@ -7,6 +7,20 @@ ROUTER_PROMPT = """Decide what to do next.
 If you need factual snippets, choose RETRIEVE.
 If you need current time, choose TIME.
 If you need to verify dependencies, choose CHECK.
-If you can answer directly, choose ANSWER.
+If you need more than one of the above, choose MULTI.
+If you can answer directly, choose ANSWER and write the answer in the answer field.
 
-Return ONLY one of: RETRIEVE, TIME, CHECK, ANSWER."""
\ No newline at end of file
+Set action to exactly one of: RETRIEVE, TIME, CHECK, MULTI, ANSWER.
+Leave answer empty unless action is ANSWER."""
+
+# Fixed system block for the router call. Kept byte-identical across turns so
+# Ollama can reuse the KV cache for the whole preamble; user text goes last.
+ROUTER_SYSTEM_PROMPT = SYSTEM_PROMPT + "\n\n" + ROUTER_PROMPT
+
+# Per-turn answer request; the preceding SystemMessage stays SYSTEM_PROMPT verbatim.
+ANSWER_PROMPT_TEMPLATE = """User request:
+{user_text}
+
+{context}
+
+Write the best possible answer. If uncertainty exists, say it and propose a safe next step."""
\ No newline at end of file
@@ -0,0 +1,17 @@
+import pytest
+
+pytest.importorskip("langchain_ollama")
+pytest.importorskip("langgraph")
+
+from flow_agent import calculator
+
+
+def test_calculator_basic_arithmetic():
+    assert calculator("12 * 5 + 3") == "63"
+    assert calculator("2**10") == "1024"
+
+
+@pytest.mark.parametrize("expr", ["9**9**9", "2**101", "(9**99)**99"])
+def test_calculator_refuses_huge_powers(expr):
+    with pytest.raises(ValueError):
+        calculator(expr)
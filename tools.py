@@ -1,7 +1,12 @@
 from __future__ import annotations
 from datetime import datetime
-from typing import List, Dict
+from typing import Callable, List, Dict, Optional, Set, Tuple
+import functools
+import os
 import random
+import re
+import threading
+import time
 
 # Simple "tools" to show tool calling + possible failures
 
@@ -9,25 +14,150 @@ def get_time() -> str:
     """Return current time in ISO format."""
     return datetime.now().isoformat(timespec="seconds")
 
+_TOKEN_RE = re.compile(r"\w+")
+
+_CORPUS: List[Dict[str, str]] = [
+    {"title": "Risk Control: Verification", "text": "Risk controls must be verified and documented with traceable evidence."},
+    {"title": "Risk Control: Usability", "text": "User-facing risk controls should be validated with representative users when applicable."},
+    {"title": "Risk Control: Residual Risk", "text": "Residual risks must be evaluated and communicated when they remain unacceptable."},
+    {"title": "AI Safety", "text": "For LLM outputs, include guardrails: citation of sources, uncertainty handling, and escalation paths."},
+]
+
+def _tokenize(text: str) -> Set[str]:
+    return set(_TOKEN_RE.findall(text.lower()))
+
+# Per-document token sets, built once so queries are just set intersections.
+_INDEX = [(d, _tokenize(d["title"] + " " + d["text"])) for d in _CORPUS]
+_TOKENS_BY_DOC = {(d["title"], d["text"]): toks for d, toks in _INDEX}
+
+def _overlap(q_tokens: Set[str], d: Dict[str, str]) -> int:
+    toks = _TOKENS_BY_DOC.get((d["title"], d["text"]))
+    if toks is None:
+        toks = _tokenize(d["title"] + " " + d["text"])
+    return len(q_tokens & toks)
+
+# Optional Numba scorer for large corpora. Below this size the JIT dispatch
+# costs more than the Python set intersections it would replace, so numba is
+# only imported (and the arrays only built) once the corpus is this big.
+_NUMBA_MIN_DOCS = 1000
+
+def _set_matches(q_tokens: Set[str]) -> List[Tuple[int, Dict[str, str]]]:
+    # one intersection per doc; the overlap size is both the filter and the score
+    scored = [(len(q_tokens & toks), d) for d, toks in _INDEX]
+    ranked = [pair for pair in scored if pair[0] > 0]
+    ranked.sort(key=lambda pair: pair[0], reverse=True)
+    return ranked
+
+@functools.lru_cache(maxsize=1)
+def _numba_scorer() -> Optional[Callable[[Set[str]], List[Tuple[int, Dict[str, str]]]]]:
+    """Build the jitted matcher on first use; None if numba is missing or disagrees with the set path."""
+    try:
+        import numpy as np
+        from numba import njit, prange
+    except ImportError:
+        return None
+
+    @njit(cache=True, parallel=True)
+    def score(doc_offsets, doc_tokens, q_mask):
+        n_docs = doc_offsets.shape[0] - 1
+        scores = np.zeros(n_docs, dtype=np.int32)
+        for i in prange(n_docs):
+            s = 0
+            for j in range(doc_offsets[i], doc_offsets[i + 1]):
+                s += q_mask[doc_tokens[j]]
+            scores[i] = s
+        return scores
+
+    # Flat SoA layout: doc i's (unique) token ids are doc_tokens[doc_offsets[i]:doc_offsets[i+1]].
+    vocab: Dict[str, int] = {}
+    ids: List[int] = []
+    offsets = [0]
+    for _, toks in _INDEX:
+        ids.extend(vocab.setdefault(t, len(vocab)) for t in sorted(toks))
+        offsets.append(len(ids))
+    doc_offsets = np.asarray(offsets, dtype=np.int32)
+    doc_tokens = np.asarray(ids, dtype=np.int32)
+
+    def matches(q_tokens: Set[str]) -> List[Tuple[int, Dict[str, str]]]:
+        q_mask = np.zeros(len(vocab), dtype=np.uint8)
+        for t in q_tokens:
+            tid = vocab.get(t)
+            if tid is not None:
+                q_mask[tid] = 1
+        scores = score(doc_offsets, doc_tokens, q_mask)
+        hits = np.flatnonzero(scores)
+        # rank in numpy; stable sort keeps corpus order on ties, like the set path
+        order = hits[np.argsort(-scores[hits], kind="stable")]
+        return [(int(scores[i]), _CORPUS[i]) for i in order]
+
+    # parity check against the set path (same scores, docs and order) before trusting it
+    probes = [_INDEX[0][1], _INDEX[-1][1], {"risk", "safety"}, set()] if _INDEX else []
+    if any(matches(q) != _set_matches(q) for q in probes):
+        return None
+    return matches
+
+def _ranked_matches(q_tokens: Set[str]) -> List[Tuple[int, Dict[str, str]]]:
+    """(score, doc) pairs for docs sharing a token with the query, best first."""
+    if len(_CORPUS) >= _NUMBA_MIN_DOCS:
+        scorer = _numba_scorer()
+        if scorer is not None:
+            return scorer(q_tokens)
+    return _set_matches(q_tokens)
+
 def search_policy_snippets(query: str) -> List[Dict[str, str]]:
     """
     Fake mini-retrieval tool (simulates RAG retrieval).
     Intentionally small, but looks realistic.
     """
-    corpus = [
-        {"title": "Risk Control: Verification", "text": "Risk controls must be verified and documented with traceable evidence."},
-        {"title": "Risk Control: Usability", "text": "User-facing risk controls should be validated with representative users when applicable."},
-        {"title": "Risk Control: Residual Risk", "text": "Residual risks must be evaluated and communicated when they remain unacceptable."},
-        {"title": "AI Safety", "text": "For LLM outputs, include guardrails: citation of sources, uncertainty handling, and escalation paths."},
-    ]
-    q = query.lower()
-    results = [d for d in corpus if any(w in (d["title"] + " " + d["text"]).lower() for w in q.split())]
-    return results[:3] if results else corpus[:2]
+    results = [d for _, d in _ranked_matches(_tokenize(query))]
+    return results[:3] if results else _CORPUS[:2]
+
+def rank_snippets(query: str, snippets: List[Dict[str, str]]) -> List[Tuple[int, Dict[str, str]]]:
+    """
+    Deduplicate snippets and sort them by query-token overlap (highest first).
+    Returns (score, snippet) pairs.
+    """
+    q_tokens = _tokenize(query)
+    seen = set()
+    scored = []
+    for d in snippets:
+        key = (d["title"], d["text"])
+        if key in seen:
+            continue
+        seen.add(key)
+        scored.append((_overlap(q_tokens, d), d))
+    scored.sort(key=lambda pair: pair[0], reverse=True)
+    return scored
+
+# Module-private generator (not the global `random` state); only used under _check_lock.
+_rng = random.Random(os.urandom(8))
+# (monotonic timestamp, error message or None) of the last real check.
+_last_check: Tuple[float, Optional[str]] = (0.0, None)
+_check_lock = threading.Lock()
+_CHECK_TTL_S = 5.0
+
+def flaky_dependency_check_v2() -> Tuple[bool, str]:
+    """
+    Same as flaky_dependency_check, but reports failure as (False, message)
+    instead of raising. A result is reused for a few seconds instead of re-rolled.
+    """
+    global _last_check
+    # read, roll and write together so each TTL window has exactly one result
+    with _check_lock:
+        now = time.monotonic()
+        checked_at, error = _last_check
+        if now - checked_at >= _CHECK_TTL_S:
+            error = "Simulated tool failure: dependency service unavailable" if _rng.random() < 0.35 else None
+            _last_check = (now, error)
+    if error:
+        return False, error
+    return True, "All dependency checks passed."
 
 def flaky_dependency_check() -> str:
     """
     Tool that sometimes fails to demonstrate fallback routing.
     """
-    if random.random() < 0.35:
-        raise RuntimeError("Simulated tool failure: dependency service unavailable")
-    return "All dependency checks passed."
\ No newline at end of file
+    ok, msg = flaky_dependency_check_v2()
+    if not ok:
+        raise RuntimeError(msg)
+    return msg